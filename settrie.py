@@ -1,15 +1,48 @@
 import bisect
 import collections
+import itertools
+import multiprocessing
+import os
+import pickle
+import struct
+import types
 import typing
+import weakref
+import zlib
 
 __version__ = "0.2.4"
-__all__ = ["SetTrie", "SetTrieDict"]
+__all__ = [
+    "DurableSetTrie",
+    "DurableSetTrieDict",
+    "KeySet",
+    "SetTrie",
+    "SetTrieDict",
+    "ShardedSetTrie",
+    "ShardedSetTrieDict",
+    "to_keysets",
+]
 
 
 _KT = typing.TypeVar("_KT")
 _VT = typing.TypeVar("_VT")
 
 
+class _Missing:
+    """Sentinel for a missing value. Unpickles to the same object, so the
+    identity checks still work on pickled or copied tries."""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<missing>"
+
+    def __reduce__(self):
+        return "_MISSING"
+
+
+_MISSING = _Missing()
+
+
 class SortedDict(collections.OrderedDict):
     """Sorted dict. Iteration order is always sorted by its key."""
 
@@ -33,6 +66,70 @@ class SortedDict(collections.OrderedDict):
         super().__delitem__(v)
         self._klist.pop(bisect.bisect_left(self._klist, v))
 
+    def __reduce__(self):
+        # rebuild the key list by inserting the items again; copy.deepcopy
+        # would restore a stale key list before the items otherwise
+        return self.__class__, (), None, None, iter(self.items())
+
+    def pop(self, k, *args):
+        is_delete = k in self
+
+        v = super().pop(k, *args)
+        if is_delete:
+            self._klist.pop(bisect.bisect_left(self._klist, k))
+        return v
+
+
+class KeySet(tuple, typing.Generic[_KT]):
+    """Canonical key set: an immutable tuple whose elements are sorted and
+    deduplicated. The hash is computed once and cached.
+
+    All the trie methods accept it as-is without sorting it again, so it is
+    worth to convert the key sets in advance when they are queried repeatedly.
+    """
+
+    def __new__(cls, iterable: "_T_KEYSET_COMPITABLE" = ()) -> "KeySet[_KT]":
+        if isinstance(iterable, KeySet):
+            return iterable
+        return super().__new__(cls, sorted(set(iterable)))
+
+    def __hash__(self) -> int:
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = tuple.__hash__(self)
+            return self._hash
+
+    def __reduce__(self):
+        # don't pickle the cached hash, it may differ in another interpreter
+        return KeySet, (tuple(self),)
+
+    def __repr__(self):
+        return "KeySet(%s)" % tuple.__repr__(self)
+
+
+def to_keysets(
+    iterable: "typing.Iterable[_T_KEYSET_COMPITABLE]",
+) -> "typing.List[KeySet[_KT]]":
+    """Convert many key sets to `KeySet` at once."""
+    return [KeySet(akey) for akey in iterable]
+
+
+def _canonical(akey: "_T_KEYSET_COMPITABLE") -> "typing.Sequence[_KT]":
+    """(internal) Get sorted and deduplicated elements of the key set. `KeySet`
+    is returned as-is; otherwise a plain list is built, which is cheaper than
+    creating a `KeySet`."""
+    if isinstance(akey, KeySet):
+        return akey
+    return sorted(set(akey))
+
+
+def _canonical_many(
+    iterable: "typing.Iterable[_T_KEYSET_COMPITABLE]",
+) -> "typing.List[typing.Sequence[_KT]]":
+    """(internal) `_canonical` for many key sets."""
+    return [_canonical(akey) for akey in iterable]
+
 
 class _SimpleNode(typing.Generic[_KT]):
     """Node object used by SetTrie. You probably don't need to use it from
@@ -68,10 +165,11 @@ class _SimpleNode(typing.Generic[_KT]):
 class _ValueNode(_SimpleNode, typing.Generic[_KT, _VT]):
     """Node with value."""
 
-    __slots__ = ("value",)
+    __slots__ = ("value", "aggregate")
 
     children: "typing.Dict[_KT, _ValueNode[_KT]]"
     value: "_VT"
+    aggregate: "_VT"
 
     def __init__(self, data: "_KT" = None, value: "_VT" = None):
         super().__init__(data)
@@ -79,6 +177,10 @@ class _ValueNode(_SimpleNode, typing.Generic[_KT, _VT]):
         # True, otherwise None
         self.value = None
 
+        # aggregated value of this node and all its descendants; only
+        # maintained when SetTrieDict is created with an aggregate function
+        self.aggregate = _MISSING
+
 
 _T_NODE = typing.Union[_SimpleNode, _ValueNode]
 _T_KEYSET = typing.Tuple[_KT]
@@ -86,6 +188,25 @@ _T_KEYSET_COMPITABLE = typing.Iterable[_KT]
 _T_KEY_ITER = typing.Iterator[_KT]
 
 
+_join_state = None
+
+
+def _containment_join_init(root, lcls, rcls):
+    """(internal) Initializer of containment_join worker processes."""
+    global _join_state
+    _join_state = root, lcls, rcls
+
+
+def _containment_join_part(part):
+    """(internal) Join the left trie with a part of the right trie in worker
+    process."""
+    root, lcls, rcls = _join_state
+    return [
+        (lcls._to_item(lset, lnode), rcls._to_item(rset, rnode))
+        for lset, lnode, rset, rnode in _SetTrie._containment_join(root, part, [], [])
+    ]
+
+
 class _SetTrie(typing.Generic[_KT, _VT]):
     """Abstracted set trie implement."""
 
@@ -93,8 +214,9 @@ class _SetTrie(typing.Generic[_KT, _VT]):
 
     @staticmethod
     def _to_keyset(akey: "_T_KEYSET_COMPITABLE") -> "_T_KEY_ITER":
-        """Convert any input to a valid iterator type for internal use."""
-        return iter(sorted(set(akey)))
+        """Convert any input to a valid iterator type for internal use. `KeySet`
+        is used without sorting."""
+        return iter(_canonical(akey))
 
     def __len__(self):
         """Trie size."""
@@ -114,6 +236,43 @@ class _SetTrie(typing.Generic[_KT, _VT]):
         for aset, _ in self._iter(self.root, []):
             yield aset
 
+    def containment_join(self, other, processes: "int" = None):
+        """Visit each pair of sets (a, b) where a is in this trie, b is in the
+        other trie and a is subset of b. Both tries are walked together, so
+        the shared prefixes are only visited once.
+
+        Sets are given as key sets for `SetTrie`, and as (key set, value)
+        pairs for `SetTrieDict`.
+
+        If processes is given, the other trie is partitioned by its smallest
+        elements and joined in that many worker processes. The pairs are
+        yielded in no particular order in this case.
+        """
+        if processes is None:
+            for lset, lnode, rset, rnode in self._containment_join(
+                self.root, other.root, [], []
+            ):
+                yield self._to_item(lset, lnode), other._to_item(rset, rnode)
+            return
+
+        if self.root.is_leaf and other.root.is_leaf:
+            yield self._to_item((), self.root), other._to_item((), other.root)
+
+        parts = []
+        for key, child in other.root.children.items():
+            part = other.Node()
+            part.children[key] = child
+            parts.append(part)
+
+        context = multiprocessing.get_context()
+        with context.Pool(
+            processes,
+            initializer=_containment_join_init,
+            initargs=(self.root, type(self), type(other)),
+        ) as pool:
+            for pairs in pool.imap_unordered(_containment_join_part, parts):
+                yield from pairs
+
     @classmethod
     def _iter(cls, node, path):
         # type: (_T_NODE, list) -> typing.Generator[typing.Tuple[_T_KEYSET, _T_NODE]]
@@ -160,7 +319,7 @@ class _SetTrie(typing.Generic[_KT, _VT]):
 
     def has_superset(self, aset: "_T_KEYSET_COMPITABLE") -> "bool":
         """Check if any set in the trie is superset of given aset."""
-        return self._has_superset(self.root, sorted(set(aset)), 0)
+        return self._has_superset(self.root, _canonical(aset), 0)
 
     @classmethod
     def _has_superset(cls, node, setarr, idx):
@@ -207,7 +366,7 @@ class _SetTrie(typing.Generic[_KT, _VT]):
 
     def has_subset(self, aset: "_T_KEYSET_COMPITABLE") -> "bool":
         """Check if any set in the trie is subset of given aset."""
-        return self._has_subset(self.root, sorted(set(aset)), 0)
+        return self._has_subset(self.root, _canonical(aset), 0)
 
     @classmethod
     def _has_subset(cls, node: "_T_NODE", setarr: "_T_KEYSET", idx: "int"):
@@ -250,6 +409,130 @@ class _SetTrie(typing.Generic[_KT, _VT]):
         if node.data is not None:
             path.pop()
 
+    @classmethod
+    def _containment_join(cls, lnode, rnode, lpath, rpath):
+        # type: (_T_NODE, _T_NODE, list, list) -> typing.Generator[typing.Tuple[_T_KEYSET, _T_NODE, _T_KEYSET, _T_NODE]]
+        """(internal) Visit each pair of sets under lnode and rnode where the
+        former one is subset of the latter one. lpath must be subset of rpath.
+        """
+        if lnode.is_leaf and rnode.is_leaf:
+            yield tuple(lpath), lnode, tuple(rpath), rnode
+
+        lchildren = lnode.children
+        lmax = next(reversed(lchildren)) if lchildren else None
+        for key, rchild in rnode.children.items():
+            rpath.append(key)
+
+            lchild = lchildren.get(key)
+            if lchild:
+                lpath.append(key)
+                yield from cls._containment_join(lchild, rchild, lpath, rpath)
+                lpath.pop()
+
+            # skip this element in right set, as long as there is still
+            # something in left subtree could be matched
+            if lnode.is_leaf or (lchildren and key < lmax):
+                yield from cls._containment_join(lnode, rchild, lpath, rpath)
+
+            rpath.pop()
+
+    def _refresh_node(self, node: "_T_NODE") -> None:
+        """(internal) Called on each node that is kept after bulk removal."""
+
+    def _bulk_remove(self, walk, *args):
+        # type: (typing.Callable, *typing.Any) -> typing.List[typing.Tuple[_T_KEYSET, _T_NODE]]
+        """(internal) Remove the sets matched by walk in a single traversal and
+        return the removed sets along with their nodes."""
+        removed = []
+        if walk(self.root, *args, removed):
+            self.root = self.Node()
+        return removed
+
+    def _remove_supersets(self, node, setarr, idx, path, removed):
+        # type: (_T_NODE, _T_KEYSET, int, list, list) -> bool
+        """(internal) Used by remove_supersets. Returns True if node could be
+        pruned."""
+        if idx >= len(setarr):
+            # fully matched: drop the whole subtree
+            removed.extend(self._iter(node, path))
+            return True
+
+        if node.data is not None:
+            path.append(node.data)
+
+        pruned = []
+        for key, child in node.children.items():
+            if key > setarr[idx]:
+                break
+            if key == setarr[idx]:
+                is_empty = self._remove_supersets(child, setarr, idx + 1, path, removed)
+            else:
+                is_empty = self._remove_supersets(child, setarr, idx, path, removed)
+            if is_empty:
+                pruned.append(key)
+
+        for key in pruned:
+            del node.children[key]
+
+        if node.data is not None:
+            path.pop()
+
+        self._refresh_node(node)
+        return not node.is_leaf and not node.children
+
+    def _remove_subsets(self, node, setarr, idx, path, removed):
+        # type: (_T_NODE, _T_KEYSET, int, list, list) -> bool
+        """(internal) Used by remove_subsets. Returns True if node could be
+        pruned."""
+        if node.data is not None:
+            path.append(node.data)
+
+        if node.is_leaf:
+            removed.append((tuple(path), node))
+            node.is_leaf = False
+
+        pruned = []
+        for key, child in node.children.items():
+            jdx = bisect.bisect_left(setarr, key, idx)
+            if jdx >= len(setarr):
+                break
+            if setarr[jdx] != key:
+                continue
+            if self._remove_subsets(child, setarr, jdx + 1, path, removed):
+                pruned.append(key)
+
+        for key in pruned:
+            del node.children[key]
+
+        if node.data is not None:
+            path.pop()
+
+        self._refresh_node(node)
+        return not node.is_leaf and not node.children
+
+    def _discard_many(self, node, keysets, depth, removed):
+        # type: (_T_NODE, typing.List[KeySet], int, list) -> bool
+        """(internal) Used by discard_many. All keysets share the same first
+        depth elements, which is the path to node. Returns True if node could
+        be pruned."""
+        groups = collections.defaultdict(list)
+        for keyset in keysets:
+            if len(keyset) > depth:
+                groups[keyset[depth]].append(keyset)
+            elif node.is_leaf:
+                removed.append((tuple(keyset), node))
+                node.is_leaf = False
+
+        for data, group in groups.items():
+            child = node.children.get(data)
+            if not child:
+                continue
+            if self._discard_many(child, group, depth + 1, removed):
+                del node.children[data]
+
+        self._refresh_node(node)
+        return not node.is_leaf and not node.children
+
     @classmethod
     def _remove(cls, node, it):
         # type: (_T_NODE, _T_KEY_ITER) -> typing.Tuple[bool, _T_NODE]
@@ -302,15 +585,35 @@ class SetTrie(_SetTrie, typing.MutableSet[_KT]):
     def iter_supersets(self, aset):
         # type: (_T_KEYSET_COMPITABLE) -> typing.Generator[_T_KEYSET]
         """Visit each supersets of given aset in the trie."""
-        for rset, _ in self._iter_supersets(self.root, sorted(set(aset)), 0, []):
+        for rset, _ in self._iter_supersets(self.root, _canonical(aset), 0, []):
             yield rset
 
     def iter_subsets(self, aset):
         # type: (_T_KEYSET_COMPITABLE) -> typing.Generator[_T_KEYSET]
         """Visit each subsets of given aset in the trie."""
-        for rset, _ in self._iter_subsets(self.root, sorted(set(aset)), 0, []):
+        for rset, _ in self._iter_subsets(self.root, _canonical(aset), 0, []):
             yield rset
 
+    def remove_supersets(self, aset: "_T_KEYSET_COMPITABLE") -> "int":
+        """Remove each supersets of given aset from the trie. Returns the
+        number of removed sets."""
+        return len(self._bulk_remove(self._remove_supersets, _canonical(aset), 0, []))
+
+    def remove_subsets(self, aset: "_T_KEYSET_COMPITABLE") -> "int":
+        """Remove each subsets of given aset from the trie. Returns the number
+        of removed sets."""
+        return len(self._bulk_remove(self._remove_subsets, _canonical(aset), 0, []))
+
+    def discard_many(self, iterable: "typing.Iterable[_T_KEYSET_COMPITABLE]") -> "int":
+        """Remove the given sets from the trie if present. Returns the number
+        of removed sets."""
+        return len(self._bulk_remove(self._discard_many, _canonical_many(iterable), 0))
+
+    @staticmethod
+    def _to_item(aset: "_T_KEYSET", node: "_SimpleNode") -> "_T_KEYSET":
+        """(internal) Output format used by containment_join."""
+        return aset
+
 
 class SetTrieDict(_SetTrie, typing.MutableMapping[_KT, _VT]):
     """Mapping container for efficient storage of key-value pairs where the keys
@@ -321,12 +624,21 @@ class SetTrieDict(_SetTrie, typing.MutableMapping[_KT, _VT]):
 
     __marker = object()
 
-    def __init__(self, iterable=None):
+    def __init__(self, iterable=None, aggregate=None):
+        # optional binary function for combining values, e.g. min, max or
+        # operator.add; must be associative and commutative
+        self._aggregate: "typing.Callable[[_VT, _VT], _VT]" = None
         self.root = self.Node()
         if iterable is not None:
             for key, value in iterable:
                 self.assign(key, value)
 
+        # computing aggregates once after all the items are inserted is far
+        # cheaper than updating them on each insertion
+        if aggregate is not None:
+            self._aggregate = aggregate
+            self._rebuild_aggregate(self.root)
+
     def __repr__(self):
         return f"<SetTrieDict with {len(self)} sets>"
 
@@ -338,8 +650,26 @@ class SetTrieDict(_SetTrie, typing.MutableMapping[_KT, _VT]):
         self[akey] = avalue
 
     def __setitem__(self, akey: "_T_KEYSET_COMPITABLE", avalue: "_VT") -> None:
-        node = self._add(self.root, self._to_keyset(akey))
+        self._set(_canonical(akey), avalue)
+
+    def _set(self, keyset: "typing.Sequence[_KT]", avalue: "_VT") -> None:
+        """(internal) __setitem__ with a canonical key set."""
+        if self._aggregate is None:
+            node = self._add(self.root, iter(keyset))
+            node.value = avalue
+            return
+
+        node = self._get(self.root, iter(keyset))
+        is_update = node is not None and node.is_leaf
+
+        node = self._add(self.root, iter(keyset))
         node.value = avalue
+        if is_update:
+            self._refresh_aggregate(keyset)
+        else:
+            # new value: just fold it into the aggregates along the path
+            for node in self._path(keyset):
+                node.aggregate = self._combine(node.aggregate, avalue)
 
     def get(self, akey: "_T_KEYSET_COMPITABLE", default=None) -> "_VT":
         node = self._get(self.root, self._to_keyset(akey))
@@ -354,12 +684,11 @@ class SetTrieDict(_SetTrie, typing.MutableMapping[_KT, _VT]):
         return node.value
 
     def __delitem__(self, akey: "_T_KEYSET_COMPITABLE"):
-        _, node = self._remove(self.root, self._to_keyset(akey))
-        if not node:
+        if not self._pop_node(_canonical(akey)):
             raise KeyError(akey)
 
     def pop(self, akey: "_T_KEYSET_COMPITABLE", default: "_VT" = __marker) -> "_VT":
-        _, node = self._remove(self.root, self._to_keyset(akey))
+        node = self._pop_node(_canonical(akey))
         if node:
             return node.value
         elif default is self.__marker:
@@ -367,14 +696,832 @@ class SetTrieDict(_SetTrie, typing.MutableMapping[_KT, _VT]):
         else:
             return default
 
+    def _pop_node(self, keyset: "typing.Sequence[_KT]") -> "_ValueNode":
+        """(internal) Remove a canonical key set. Returns the removed node, or
+        None if not found."""
+        _, node = self._remove(self.root, iter(keyset))
+        if node and self._aggregate is not None:
+            self._refresh_aggregate(keyset)
+        return node
+
     def iter_supersets(self, aset):
         # type: (_T_KEYSET_COMPITABLE) -> typing.Generator[typing.Tuple[_T_KEYSET, _VT]]
         """Visit each supersets of given aset in the trie."""
-        for rset, node in self._iter_supersets(self.root, sorted(set(aset)), 0, []):
+        for rset, node in self._iter_supersets(self.root, _canonical(aset), 0, []):
             yield rset, node.value
 
     def iter_subsets(self, aset):
         # type: (_T_KEYSET_COMPITABLE) -> typing.Generator[_T_KEYSET]
         """Visit each subsets of given aset in the trie."""
-        for rset, node in self._iter_subsets(self.root, sorted(set(aset)), 0, []):
+        for rset, node in self._iter_subsets(self.root, _canonical(aset), 0, []):
             yield rset, node.value
+
+    def remove_supersets(self, aset):
+        # type: (_T_KEYSET_COMPITABLE) -> typing.List[typing.Tuple[_T_KEYSET, _VT]]
+        """Remove each supersets of given aset from the trie. Returns the
+        removed items."""
+        removed = self._bulk_remove(self._remove_supersets, _canonical(aset), 0, [])
+        return [(rset, node.value) for rset, node in removed]
+
+    def remove_subsets(self, aset):
+        # type: (_T_KEYSET_COMPITABLE) -> typing.List[typing.Tuple[_T_KEYSET, _VT]]
+        """Remove each subsets of given aset from the trie. Returns the removed
+        items."""
+        removed = self._bulk_remove(self._remove_subsets, _canonical(aset), 0, [])
+        return [(rset, node.value) for rset, node in removed]
+
+    def discard_many(self, iterable):
+        # type: (typing.Iterable[_T_KEYSET_COMPITABLE]) -> typing.List[typing.Tuple[_T_KEYSET, _VT]]
+        """Remove the given key sets from the trie if present. Returns the
+        removed items."""
+        removed = self._bulk_remove(self._discard_many, _canonical_many(iterable), 0)
+        return [(rset, node.value) for rset, node in removed]
+
+    @staticmethod
+    def _to_item(aset, node):
+        # type: (_T_KEYSET, _ValueNode) -> typing.Tuple[_T_KEYSET, _VT]
+        """(internal) Output format used by containment_join."""
+        return aset, node.value
+
+    def aggregate_supersets(self, aset: "_T_KEYSET_COMPITABLE", default=None) -> "_VT":
+        """Aggregate the values of all supersets of given aset in the trie.
+        Returns default if there is no superset."""
+        self._check_aggregate()
+        result = self._aggregate_supersets(self.root, _canonical(aset), 0)
+        return default if result is _MISSING else result
+
+    def aggregate_subsets(self, aset: "_T_KEYSET_COMPITABLE", default=None) -> "_VT":
+        """Aggregate the values of all subsets of given aset in the trie.
+        Returns default if there is no subset."""
+        self._check_aggregate()
+        result = _MISSING
+        for _, node in self._iter_subsets(self.root, _canonical(aset), 0, []):
+            result = self._combine(result, node.value)
+        return default if result is _MISSING else result
+
+    def _check_aggregate(self):
+        if self._aggregate is None:
+            raise ValueError("aggregate function is not set for this trie")
+
+    def _combine(self, lhs: "_VT", rhs: "_VT") -> "_VT":
+        """(internal) Apply the aggregate function; _MISSING is the identity."""
+        if lhs is _MISSING:
+            return rhs
+        if rhs is _MISSING:
+            return lhs
+        return self._aggregate(lhs, rhs)
+
+    def _path(self, keyset: "_T_KEYSET") -> "typing.List[_ValueNode]":
+        """(internal) Get the existing nodes along the path of the key set,
+        starting from root."""
+        path = [self.root]
+        for data in keyset:
+            node = path[-1].children.get(data)
+            if node is None:  # pruned by removal
+                break
+            path.append(node)
+        return path
+
+    def _refresh_aggregate(self, keyset: "_T_KEYSET") -> None:
+        """(internal) Recompute the aggregates of the nodes along the path of
+        the key set, from the bottom up until one of them is unchanged."""
+        for node in reversed(self._path(keyset)):
+            old = node.aggregate
+            self._refresh_node(node)
+            if node.aggregate is old or (node.aggregate == old) is True:
+                break
+
+    def _rebuild_aggregate(self, node: "_ValueNode") -> None:
+        """(internal) Recompute the aggregates of the whole subtree."""
+        for child in node.children.values():
+            self._rebuild_aggregate(child)
+        self._refresh_node(node)
+
+    def _refresh_node(self, node: "_ValueNode") -> None:
+        """(internal) Recompute the aggregate of node from its children."""
+        if self._aggregate is None:
+            return
+        result = node.value if node.is_leaf else _MISSING
+        for child in node.children.values():
+            result = self._combine(result, child.aggregate)
+        node.aggregate = result
+
+    def _aggregate_supersets(self, node, setarr, idx):
+        # type: (_ValueNode, _T_KEYSET, int) -> _VT
+        """(internal) Used by aggregate_supersets."""
+        if idx >= len(setarr):
+            # fully matched: every set in this subtree is a superset
+            return node.aggregate
+
+        result = _MISSING
+        for key, child in node.children.items():
+            if key > setarr[idx]:
+                break
+            if key == setarr[idx]:
+                found = self._aggregate_supersets(child, setarr, idx + 1)
+            else:
+                found = self._aggregate_supersets(child, setarr, idx)
+            result = self._combine(result, found)
+        return result
+
+
+_REQ_CALL = 1
+_REQ_CALL_MANY = 2
+_REQ_OPEN_CURSOR = 3
+_REQ_NEXT_BATCH = 4
+_REQ_CLOSE_CURSOR = 5
+
+
+def _shard_worker(conn, trie_cls):
+    """(internal) Main loop of a shard process. Receives ``(method, args,
+    request type)`` requests from the connection and sends back ``(ok,
+    result)``.
+
+    Generator methods are served through cursors: opening one returns the
+    cursor id along with the first batch, and the rest are fetched batch by
+    batch, so the results never need to be held at once.
+    """
+    trie = trie_cls()
+    cursors = {}
+    cursor_ids = itertools.count()
+
+    def next_batch(cursor):
+        it, batch_size = cursors[cursor]
+        try:
+            batch = list(itertools.islice(it, batch_size))
+        except Exception:
+            del cursors[cursor]
+            raise
+        done = len(batch) < batch_size
+        if done:
+            del cursors[cursor]
+        return batch, done
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:  # shutdown
+            break
+
+        name, args, reqtype = request
+        try:
+            if reqtype == _REQ_CALL:
+                result = getattr(trie, name)(*args)
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+            elif reqtype == _REQ_CALL_MANY:
+                method = getattr(trie, name)
+                for arg in args:
+                    method(*arg)
+                result = None
+            elif reqtype == _REQ_OPEN_CURSOR:
+                args, batch_size = args
+                cursor = next(cursor_ids)
+                cursors[cursor] = iter(getattr(trie, name)(*args)), batch_size
+                result = (cursor, *next_batch(cursor))
+            elif reqtype == _REQ_NEXT_BATCH:
+                (cursor,) = args
+                result = next_batch(cursor)
+            elif reqtype == _REQ_CLOSE_CURSOR:
+                (cursor,) = args
+                cursors.pop(cursor, None)
+                result = None
+        except Exception as e:
+            conn.send((False, e))
+        else:
+            conn.send((True, result))
+
+    conn.close()
+
+
+def _stop_shards(conns, procs):
+    """(internal) Stop the shard processes. Used as finalizer of sharded tries,
+    so it must not refer to the trie itself."""
+    for conn in conns:
+        try:
+            conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        conn.close()
+    for proc in procs:
+        proc.join()
+
+
+class _ShardedSetTrie:
+    """Abstracted sharded set trie implement. Key sets are partitioned by hash
+    across shard tries, each one lives in its own worker process."""
+
+    Trie: "typing.Type[_SetTrie]"
+
+    # number of results sent from a shard at a time when iterating
+    batch_size = 1024
+
+    def __init__(self, shards: "int" = None, context=None):
+        if shards is None:
+            shards = os.cpu_count() or 1
+        if shards < 1:
+            raise ValueError("shards must be a positive integer")
+        if context is None:
+            context = multiprocessing.get_context()
+
+        self._conns = []
+        self._procs = []
+        for _ in range(shards):
+            parent_conn, child_conn = context.Pipe()
+            proc = context.Process(
+                target=_shard_worker, args=(child_conn, self.Trie), daemon=True
+            )
+            proc.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._procs.append(proc)
+
+        # stop the processes when the trie is garbage collected without close
+        self._finalizer = weakref.finalize(
+            self, _stop_shards, self._conns, self._procs
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        """Stop all the shard processes. Further operations raise ValueError."""
+        self._finalizer()
+        self._conns = []
+        self._procs = []
+
+    def _check_open(self) -> None:
+        """(internal) Raise if the shards are stopped, like a closed file does."""
+        if not self._conns:
+            raise ValueError("operation on closed trie")
+
+    @property
+    def shards(self) -> "int":
+        """Number of shards."""
+        return len(self._conns)
+
+    def _route(self, akey: "_T_KEYSET_COMPITABLE") -> "typing.Tuple[int, _T_KEYSET]":
+        """Convert the input into a key set and get the index of its owner."""
+        self._check_open()
+        if isinstance(akey, KeySet):
+            keyset = akey
+        else:
+            keyset = tuple(sorted(set(akey)))
+        return hash(keyset) % len(self._conns), keyset
+
+    @staticmethod
+    def _recv(conn):
+        ok, result = conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def _request(self, idx: "int", request: "tuple"):
+        """(internal) Send a request to a single shard and wait for the reply."""
+        self._check_open()
+        conn = self._conns[idx]
+        conn.send(request)
+        return self._recv(conn)
+
+    def _call(self, idx: "int", name: "str", *args):
+        """(internal) Call method on a single shard."""
+        return self._request(idx, (name, args, _REQ_CALL))
+
+    def _call_many(self, idx: "int", name: "str", arglist: "list") -> None:
+        """(internal) Call method on a single shard once for each args."""
+        self._request(idx, (name, arglist, _REQ_CALL_MANY))
+
+    def _request_all(self, request: "tuple") -> "list":
+        """(internal) Send a request to all shards in parallel and collect the
+        raw ``(ok, result)`` replies in shard order."""
+        self._check_open()
+        for conn in self._conns:
+            conn.send(request)
+
+        # read all the replies before raising, or the leftovers would be taken
+        # as the replies of the next call
+        return [conn.recv() for conn in self._conns]
+
+    def _broadcast(self, name: "str", *args) -> "list":
+        """(internal) Call method on all shards in parallel and collect the
+        results in shard order."""
+        replies = self._request_all((name, args, _REQ_CALL))
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for _, result in replies]
+
+    def _stream(self, name: "str", *args):
+        """(internal) Call generator method on all shards in parallel, then
+        stream the results from each shard in turn, `batch_size` at a time."""
+        replies = self._request_all(
+            (name, (args, self.batch_size), _REQ_OPEN_CURSOR)
+        )
+
+        # shard index -> cursor id, for the cursors not exhausted yet
+        cursors = {}
+        for idx, (ok, result) in enumerate(replies):
+            if ok and not result[2]:
+                cursors[idx] = result[0]
+
+        try:
+            for ok, result in replies:
+                if not ok:
+                    raise result
+
+            for idx, (_, (cursor, batch, done)) in enumerate(replies):
+                replies[idx] = None  # release the first batch once consumed
+                yield from batch
+                while not done:
+                    batch, done = self._request(idx, (None, (cursor,), _REQ_NEXT_BATCH))
+                    yield from batch
+                cursors.pop(idx, None)
+
+        finally:
+            # drop the cursors left open when failed or not fully consumed
+            if self._conns:
+                for idx, cursor in cursors.items():
+                    self._request(idx, (None, (cursor,), _REQ_CLOSE_CURSOR))
+
+    def _update(self, name: "str", items) -> None:
+        """(internal) Group the items by their owner shard and send each group
+        in one request."""
+        groups = collections.defaultdict(list)
+        for akey, *rest in items:
+            idx, keyset = self._route(akey)
+            groups[idx].append((keyset, *rest))
+        for idx, arglist in groups.items():
+            self._call_many(idx, name, arglist)
+
+    def __len__(self):
+        """Trie size."""
+        return sum(self._broadcast("__len__"))
+
+    def __contains__(self, aset: "_T_KEYSET_COMPITABLE") -> bool:
+        """Check if the given set is in the trie."""
+        idx, keyset = self._route(aset)
+        return self._call(idx, "__contains__", keyset)
+
+    def __iter__(self):
+        """iter through the trie."""
+        return self._stream("__iter__")
+
+    def has_superset(self, aset: "_T_KEYSET_COMPITABLE") -> "bool":
+        """Check if any set in the trie is superset of given aset."""
+        keyset = _canonical(aset)
+        return any(self._broadcast("has_superset", keyset))
+
+    def has_subset(self, aset: "_T_KEYSET_COMPITABLE") -> "bool":
+        """Check if any set in the trie is subset of given aset."""
+        keyset = _canonical(aset)
+        return any(self._broadcast("has_subset", keyset))
+
+    def iter_supersets(self, aset):
+        """Visit each supersets of given aset in the trie."""
+        return self._stream("iter_supersets", _canonical(aset))
+
+    def iter_subsets(self, aset):
+        """Visit each subsets of given aset in the trie."""
+        return self._stream("iter_subsets", _canonical(aset))
+
+    def _group(self, iterable) -> "typing.Dict[int, list]":
+        """(internal) Group the key sets by their owner shard."""
+        groups = collections.defaultdict(list)
+        for akey in iterable:
+            idx, keyset = self._route(akey)
+            groups[idx].append(keyset)
+        return groups
+
+
+class ShardedSetTrie(_ShardedSetTrie, typing.MutableSet[_KT]):
+    """Set-trie that partitions its sets across several `SetTrie` shards,
+    each running in a separate process. Writes are sent to the owning shard
+    while queries are fanned out to all shards and merged.
+
+    Call `close` (or use it as a context manager) to stop the processes."""
+
+    Trie = SetTrie
+
+    def __init__(self, iterable=None, shards: "int" = None, context=None):
+        super().__init__(shards, context)
+        if iterable is not None:
+            self._update("add", ((key,) for key in iterable))
+
+    def __repr__(self):
+        return f"<ShardedSetTrie with {len(self)} sets in {self.shards} shards>"
+
+    @classmethod
+    def _from_iterable(cls, iterable) -> "SetTrie":
+        """Results of set operators (e.g. `&`, `|`) are plain `SetTrie`, so no
+        worker processes are started implicitly."""
+        return SetTrie(iterable)
+
+    def add(self, aset: "_T_KEYSET_COMPITABLE") -> None:
+        idx, keyset = self._route(aset)
+        self._call(idx, "add", keyset)
+
+    def discard(self, aset: "_T_KEYSET_COMPITABLE"):
+        idx, keyset = self._route(aset)
+        self._call(idx, "discard", keyset)
+
+    def remove_supersets(self, aset: "_T_KEYSET_COMPITABLE") -> "int":
+        """Remove each supersets of given aset from the trie. Returns the
+        number of removed sets."""
+        return sum(self._broadcast("remove_supersets", _canonical(aset)))
+
+    def remove_subsets(self, aset: "_T_KEYSET_COMPITABLE") -> "int":
+        """Remove each subsets of given aset from the trie. Returns the number
+        of removed sets."""
+        return sum(self._broadcast("remove_subsets", _canonical(aset)))
+
+    def discard_many(self, iterable: "typing.Iterable[_T_KEYSET_COMPITABLE]") -> "int":
+        """Remove the given sets from the trie if present. Returns the number
+        of removed sets."""
+        groups = self._group(iterable)
+        return sum(
+            self._call(idx, "discard_many", keysets) for idx, keysets in groups.items()
+        )
+
+
+class ShardedSetTrieDict(_ShardedSetTrie, typing.MutableMapping[_KT, _VT]):
+    """Mapping version of `ShardedSetTrie`, backed by `SetTrieDict` shards.
+
+    Call `close` (or use it as a context manager) to stop the processes."""
+
+    Trie = SetTrieDict
+
+    __marker = object()
+
+    def __init__(self, iterable=None, shards: "int" = None, context=None):
+        super().__init__(shards, context)
+        if iterable is not None:
+            self._update("assign", iterable)
+
+    def __repr__(self):
+        return f"<ShardedSetTrieDict with {len(self)} sets in {self.shards} shards>"
+
+    def items(self) -> "typing.Generator[typing.Tuple[_T_KEYSET, _VT]]":
+        return self._stream("items")
+
+    def values(self) -> "typing.Generator[_VT]":
+        for _, value in self._stream("items"):
+            yield value
+
+    def assign(self, akey: "_T_KEYSET_COMPITABLE", avalue: "_VT") -> None:
+        self[akey] = avalue
+
+    def __setitem__(self, akey: "_T_KEYSET_COMPITABLE", avalue: "_VT") -> None:
+        idx, keyset = self._route(akey)
+        self._call(idx, "__setitem__", keyset, avalue)
+
+    def get(self, akey: "_T_KEYSET_COMPITABLE", default=None) -> "_VT":
+        idx, keyset = self._route(akey)
+        return self._call(idx, "get", keyset, default)
+
+    def __getitem__(self, akey: "_T_KEYSET_COMPITABLE") -> "_VT":
+        idx, keyset = self._route(akey)
+        return self._call(idx, "__getitem__", keyset)
+
+    def __delitem__(self, akey: "_T_KEYSET_COMPITABLE"):
+        idx, keyset = self._route(akey)
+        self._call(idx, "__delitem__", keyset)
+
+    def pop(self, akey: "_T_KEYSET_COMPITABLE", default: "_VT" = __marker) -> "_VT":
+        idx, keyset = self._route(akey)
+        if default is self.__marker:
+            return self._call(idx, "pop", keyset)
+        return self._call(idx, "pop", keyset, default)
+
+    def remove_supersets(self, aset):
+        # type: (_T_KEYSET_COMPITABLE) -> typing.List[typing.Tuple[_T_KEYSET, _VT]]
+        """Remove each supersets of given aset from the trie. Returns the
+        removed items."""
+        results = self._broadcast("remove_supersets", _canonical(aset))
+        return [item for result in results for item in result]
+
+    def remove_subsets(self, aset):
+        # type: (_T_KEYSET_COMPITABLE) -> typing.List[typing.Tuple[_T_KEYSET, _VT]]
+        """Remove each subsets of given aset from the trie. Returns the removed
+        items."""
+        results = self._broadcast("remove_subsets", _canonical(aset))
+        return [item for result in results for item in result]
+
+    def discard_many(self, iterable):
+        # type: (typing.Iterable[_T_KEYSET_COMPITABLE]) -> typing.List[typing.Tuple[_T_KEYSET, _VT]]
+        """Remove the given key sets from the trie if present. Returns the
+        removed items."""
+        removed = []
+        for idx, keysets in self._group(iterable).items():
+            removed.extend(self._call(idx, "discard_many", keysets))
+        return removed
+
+
+_OP_ADD = 1
+_OP_DISCARD = 2
+_OP_SET = 3
+_OP_DELETE = 4
+
+
+class _MutationLog:
+    """(internal) Append-only log of trie mutations, along with the checkpoint
+    it is applied on. Both files are kept in the given directory.
+
+    Each record is a header of opcode, payload size and CRC32, followed by the
+    pickled arguments. A torn record at the tail (e.g. after a crash) is
+    dropped when the log is replayed.
+    """
+
+    _HEADER = struct.Struct("<BII")
+
+    def __init__(self, path: "str", sync_every: "int"):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.checkpoint_path = os.path.join(path, "checkpoint")
+        self.log_path = os.path.join(path, "log")
+        self.sync_every = sync_every
+        self.records = 0  # number of records since last checkpoint
+        self._pending = 0  # number of records not yet fsync'ed
+        self._fp = None
+
+    def load_checkpoint(self) -> "list":
+        try:
+            with open(self.checkpoint_path, "rb") as fp:
+                return pickle.load(fp)
+        except FileNotFoundError:
+            return []
+
+    def replay(self, apply: "typing.Callable[[int, tuple], None]") -> None:
+        """Call apply with each valid record in the log, then open the log for
+        appending with any invalid tail cut off."""
+        valid = 0
+        try:
+            fp = open(self.log_path, "rb")
+        except FileNotFoundError:
+            pass
+        else:
+            with fp:
+                while True:
+                    header = fp.read(self._HEADER.size)
+                    if len(header) < self._HEADER.size:
+                        break
+                    op, size, crc = self._HEADER.unpack(header)
+                    payload = fp.read(size)
+                    if len(payload) < size or zlib.crc32(payload) != crc:
+                        break
+                    apply(op, pickle.loads(payload))
+                    valid = fp.tell()
+                    self.records += 1
+
+        self._fp = open(self.log_path, "ab")
+        self._fp.truncate(valid)
+
+    def append(self, op: "int", args: "tuple") -> None:
+        payload = pickle.dumps(args, pickle.HIGHEST_PROTOCOL)
+        self._fp.write(self._HEADER.pack(op, len(payload), zlib.crc32(payload)))
+        self._fp.write(payload)
+        self.records += 1
+        self._pending += 1
+        if self._pending >= self.sync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        """Flush the appended records to disk."""
+        if self._fp is None or not self._pending:
+            return
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._pending = 0
+
+    def checkpoint(self, data: "list") -> None:
+        """Atomically replace the checkpoint with data, then empty the log.
+
+        Replaying the log on the new checkpoint (i.e. a crash in between) is
+        harmless since each record only sets the final state of a key."""
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            pickle.dump(data, fp, pickle.HIGHEST_PROTOCOL)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        self._sync_dir()
+
+        self._fp.truncate(0)
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self.records = 0
+        self._pending = 0
+
+    def _sync_dir(self) -> None:
+        if not hasattr(os, "O_DIRECTORY"):  # not supported on Windows
+            return
+        fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self) -> None:
+        if self._fp is None:
+            return
+        self.sync()
+        self._fp.close()
+        self._fp = None
+
+
+class _DurableSetTrie:
+    """Abstracted durable set trie implement. Mutations are recorded in a
+    `_MutationLog` and restored on open."""
+
+    _log: "_MutationLog"
+    _OP_REMOVE: "int"  # opcode for the sets removed in bulk
+
+    def _open_log(self, path, sync_every, checkpoint_every) -> None:
+        """(internal) Restore the trie from path and start recording."""
+        self._log = None
+        self._checkpoint_every = checkpoint_every
+
+        log = _MutationLog(path, sync_every)
+        self._restoring = True
+        try:
+            self._restore(log.load_checkpoint())
+            log.replay(self._replay)
+        finally:
+            self._restoring = False
+        self._log = log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _check_open(self) -> None:
+        """(internal) Raise if the log is closed, like a closed file does."""
+        if self._log is None and not self._restoring:
+            raise ValueError("I/O operation on closed trie")
+
+    def _record(self, op: "int", *args) -> None:
+        """(internal) Append a mutation to the log."""
+        if self._restoring:
+            return
+        self._log.append(op, args)
+        if self._checkpoint_every and self._log.records >= self._checkpoint_every:
+            self.checkpoint()
+
+    def _bulk_remove(self, walk, *args):
+        self._check_open()
+        removed = super()._bulk_remove(walk, *args)
+        for rset, _ in removed:
+            self._record(self._OP_REMOVE, tuple(rset))
+        return removed
+
+    def sync(self) -> None:
+        """Flush the recorded mutations to disk."""
+        self._check_open()
+        self._log.sync()
+
+    def checkpoint(self) -> None:
+        """Write the whole trie to disk and empty the log."""
+        self._check_open()
+        self._log.checkpoint(self._snapshot())
+
+    def close(self) -> None:
+        """Flush the log and close it. Further mutations raise ValueError."""
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+class DurableSetTrie(_DurableSetTrie, SetTrie):
+    """`SetTrie` that records its mutations in an append-only log under path,
+    and is restored from it when opened again.
+
+    The log is fsync'ed once per `sync_every` mutations (and on `sync` or
+    `close`), and folded into a checkpoint once per `checkpoint_every`
+    mutations (and on `checkpoint`); set it to 0 to disable.
+    """
+
+    def __init__(
+        self,
+        path: "str",
+        iterable=None,
+        sync_every: "int" = 64,
+        checkpoint_every: "int" = 65536,
+    ):
+        super().__init__()
+        self._open_log(path, sync_every, checkpoint_every)
+        if iterable is not None:
+            for key in iterable:
+                self.add(key)
+
+    _OP_REMOVE = _OP_DISCARD
+
+    def __repr__(self):
+        return f"<DurableSetTrie with {len(self)} sets>"
+
+    @classmethod
+    def _from_iterable(cls, iterable) -> "SetTrie":
+        """Results of set operators (e.g. `&`, `|`) are plain `SetTrie`."""
+        return SetTrie(iterable)
+
+    def add(self, aset: "_T_KEYSET_COMPITABLE") -> None:
+        self._check_open()
+        keyset = _canonical(aset)
+        self._add(self.root, iter(keyset))
+        self._record(_OP_ADD, tuple(keyset))
+
+    def discard(self, aset: "_T_KEYSET_COMPITABLE"):
+        self._check_open()
+        keyset = _canonical(aset)
+        self._remove(self.root, iter(keyset))
+        self._record(_OP_DISCARD, tuple(keyset))
+
+    def _snapshot(self) -> "list":
+        return list(self)
+
+    def _restore(self, data: "list") -> None:
+        for key in data:
+            self.add(key)
+
+    def _replay(self, op: "int", args: "tuple") -> None:
+        if op == _OP_ADD:
+            self.add(*args)
+        elif op == _OP_DISCARD:
+            self.discard(*args)
+
+
+class DurableSetTrieDict(_DurableSetTrie, SetTrieDict):
+    """`SetTrieDict` that records its mutations in an append-only log under
+    path, and is restored from it when opened again. Keys and values must be
+    picklable.
+
+    See `DurableSetTrie` for `sync_every` and `checkpoint_every`.
+    """
+
+    def __init__(
+        self,
+        path: "str",
+        iterable=None,
+        aggregate=None,
+        sync_every: "int" = 64,
+        checkpoint_every: "int" = 65536,
+    ):
+        super().__init__()
+        self._open_log(path, sync_every, checkpoint_every)
+
+        # compute aggregates once after restoring, like SetTrieDict.__init__
+        if aggregate is not None:
+            self._aggregate = aggregate
+            self._rebuild_aggregate(self.root)
+
+        if iterable is not None:
+            for key, value in iterable:
+                self.assign(key, value)
+
+    _OP_REMOVE = _OP_DELETE
+
+    def __repr__(self):
+        return f"<DurableSetTrieDict with {len(self)} sets>"
+
+    def __setitem__(self, akey: "_T_KEYSET_COMPITABLE", avalue: "_VT") -> None:
+        self._check_open()
+        keyset = _canonical(akey)
+        self._set(keyset, avalue)
+        self._record(_OP_SET, tuple(keyset), avalue)
+
+    def __delitem__(self, akey: "_T_KEYSET_COMPITABLE"):
+        self._check_open()
+        keyset = _canonical(akey)
+        if not self._pop_node(keyset):
+            raise KeyError(akey)
+        self._record(_OP_DELETE, tuple(keyset))
+
+    def pop(self, akey: "_T_KEYSET_COMPITABLE", default: "_VT" = _MISSING) -> "_VT":
+        self._check_open()
+        keyset = _canonical(akey)
+        node = self._pop_node(keyset)
+        if node:
+            self._record(_OP_DELETE, tuple(keyset))
+            return node.value
+        elif default is _MISSING:
+            raise KeyError(akey)
+        else:
+            return default
+
+    def _snapshot(self) -> "list":
+        return list(self.items())
+
+    def _restore(self, data: "list") -> None:
+        for key, value in data:
+            self[key] = value
+
+    def _replay(self, op: "int", args: "tuple") -> None:
+        if op == _OP_SET:
+            self.__setitem__(*args)
+        elif op == _OP_DELETE:
+            self.pop(args[0], None)
@@ -1,5 +1,72 @@
+import copy
+import gc
+import itertools
+import operator
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
 import unittest
-from settrie import SetTrie, SetTrieDict
+from settrie import (
+    DurableSetTrie,
+    DurableSetTrieDict,
+    KeySet,
+    SetTrie,
+    SetTrieDict,
+    ShardedSetTrie,
+    ShardedSetTrieDict,
+    to_keysets,
+)
+
+
+class TestKeySet(unittest.TestCase):
+    """
+    UnitTest for KeySet class
+    """
+
+    def test_canonical(self):
+        k = KeySet([3, 1, 2, 1])
+        self.assertEqual(k, (1, 2, 3))
+        self.assertEqual(hash(k), hash((1, 2, 3)))
+        self.assertIs(KeySet(k), k)
+        self.assertEqual(repr(k), "KeySet((1, 2, 3))")
+        self.assertEqual(KeySet(), ())
+
+    def test_pickle(self):
+        k = KeySet(["b", "a"])
+        hash(k)
+        self.assertNotIn("_hash", pickle.loads(pickle.dumps(k)).__dict__)
+
+        # hash of str differs between interpreters
+        script = (
+            "import pickle, sys, settrie; "
+            "d = pickle.loads(sys.stdin.buffer.read()); "
+            "k, = d; "
+            "assert type(k) is settrie.KeySet; "
+            "assert hash(k) == hash(('a', 'b')); "
+            "assert ('a', 'b') in d"
+        )
+        subprocess.run(
+            [sys.executable, "-c", script],
+            input=pickle.dumps({k: 1}),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True,
+        )
+
+    def test_to_keysets(self):
+        ks = to_keysets([{2, 1}, [3, 3]])
+        self.assertEqual(ks, [(1, 2), (3,)])
+        self.assertTrue(all(isinstance(k, KeySet) for k in ks))
+
+    def test_trie(self):
+        t = SetTrie(to_keysets([(1, 3), (1, 3, 5), (2, 4)]))
+        self.assertIn(KeySet([3, 1]), t)
+        self.assertTrue(t.has_subset(KeySet([1, 2, 3])))
+        self.assertCountEqual(t.iter_supersets(KeySet([3])), [(1, 3), (1, 3, 5)])
+        d = SetTrieDict([(KeySet([4, 2]), "E")])
+        self.assertEqual(d[KeySet([2, 4])], "E")
 
 
 class TestSetTrie(unittest.TestCase):
@@ -96,12 +163,82 @@ class TestSetTrie(unittest.TestCase):
         self.assertCountEqual(self.t.iter_subsets((2, 3, 4, 5)), [(2, 3, 5), (2, 4)])
         self.assertCountEqual(self.t.iter_subsets((2, 3, 5, 6)), [(2, 3, 5)])
 
+    def test_containment_join(self):
+        other = SetTrie([(), (1, 3), (1, 2, 3, 5), (2, 4, 5), (3, 4)])
+        expected = [(a, b) for a in self.t for b in other if set(a) <= set(b)]
+        self.assertCountEqual(self.t.containment_join(other), expected)
+        self.assertCountEqual(self.t.containment_join(other, processes=2), expected)
+
+        self.t.add(())
+        self.assertCountEqual(
+            other.containment_join(self.t),
+            [((), b) for b in self.t] + [((1, 3), (1, 3)), ((1, 3), (1, 3, 5))],
+        )
+
+    def test_containment_join_random(self):
+        rand = random.Random(0)
+        left = SetTrie(rand.sample(range(8), rand.randint(0, 4)) for _ in range(40))
+        right = SetTrie(rand.sample(range(8), rand.randint(0, 6)) for _ in range(60))
+        expected = [
+            (a, b) for a, b in itertools.product(left, right) if set(a) <= set(b)
+        ]
+        self.assertCountEqual(left.containment_join(right), expected)
+        self.assertCountEqual(left.containment_join(right, processes=2), expected)
+
     def test_discard(self):
         self.assertIn([1, 3], self.t)
         self.t.discard((1, 3))
         self.assertIn([1, 3, 5], self.t)
         self.assertNotIn([1, 3], self.t)
 
+    def test_discard_add(self):
+        self.t.discard((2, 4))
+        self.t.add((0, 4))
+        self.assertCountEqual(
+            list(self.t), [(0, 4), (1, 2, 4), (1, 3), (1, 3, 5), (1, 4), (2, 3, 5)]
+        )
+
+    def test_remove_supersets(self):
+        self.assertEqual(self.t.remove_supersets((3,)), 3)
+        self.assertCountEqual(list(self.t), [(1, 2, 4), (1, 4), (2, 4)])
+        self.assertEqual(self.t.remove_supersets((6,)), 0)
+        self.assertEqual(self.t.remove_supersets((1, 4)), 2)
+        self.assertCountEqual(list(self.t), [(2, 4)])
+        self.t.add(())
+        self.assertEqual(self.t.remove_supersets(()), 2)
+        self.assertEqual(list(self.t), [])
+        self.t.add((1,))
+        self.assertEqual(list(self.t), [(1,)])
+
+    def test_remove_subsets(self):
+        self.assertEqual(self.t.remove_subsets((1, 2, 3, 4)), 4)
+        self.assertCountEqual(list(self.t), [(1, 3, 5), (2, 3, 5)])
+        self.assertEqual(self.t.remove_subsets((1, 2)), 0)
+        self.assertEqual(self.t.remove_subsets((1, 2, 3, 5)), 2)
+        self.assertEqual(list(self.t), [])
+
+    def test_discard_many(self):
+        self.assertEqual(self.t.discard_many([(3, 1), (1, 4), (1, 4), (1,), (7, 8)]), 2)
+        self.assertCountEqual(list(self.t), [(1, 2, 4), (1, 3, 5), (2, 3, 5), (2, 4)])
+        self.assertEqual(self.t.discard_many(list(self.t)), 4)
+        self.assertEqual(list(self.t), [])
+
+    def test_remove_random(self):
+        rand = random.Random(0)
+        keys = [
+            tuple(sorted(rand.sample(range(8), rand.randint(0, 5)))) for _ in range(80)
+        ]
+        for method in ("remove_supersets", "remove_subsets"):
+            for _ in range(20):
+                t = SetTrie(keys)
+                query = set(rand.sample(range(8), rand.randint(0, 4)))
+                if method == "remove_supersets":
+                    expected = [k for k in set(keys) if query <= set(k)]
+                else:
+                    expected = [k for k in set(keys) if set(k) <= query]
+                self.assertEqual(getattr(t, method)(query), len(expected))
+                self.assertCountEqual(list(t), set(keys) - set(expected))
+
 
 class TestSetTrieDict(unittest.TestCase):
     """
@@ -238,11 +375,450 @@ class TestSetTrieDict(unittest.TestCase):
         )
         self.assertCountEqual(self.t.values(), ["D", "A", "B", "C", "F", "E"])
 
+    def test_containment_join(self):
+        other = SetTrieDict([((1, 3, 4), "x"), ((2, 3, 5), "y")])
+        self.assertCountEqual(
+            self.t.containment_join(other),
+            [
+                (((1, 3), "A"), ((1, 3, 4), "x")),
+                (((1, 4), "C"), ((1, 3, 4), "x")),
+                (((2, 3, 5), "F"), ((2, 3, 5), "y")),
+            ],
+        )
+        self.assertCountEqual(
+            SetTrie([(3,)]).containment_join(other, processes=2),
+            [((3,), ((1, 3, 4), "x")), ((3,), ((2, 3, 5), "y"))],
+        )
+
     def test_pop(self):
         self.assertEqual(self.t.pop([1, 3]), "A")
         self.assertIn([1, 3, 5], self.t)
         self.assertNotIn([1, 3], self.t)
 
+    def test_remove(self):
+        self.assertCountEqual(
+            self.t.remove_supersets((3,)),
+            [((1, 3), "A"), ((1, 3, 5), "B"), ((2, 3, 5), "F")],
+        )
+        self.assertCountEqual(self.t.remove_subsets((1, 4)), [((1, 4), "C")])
+        self.assertEqual(self.t.discard_many([(4, 2), (9,)]), [((2, 4), "E")])
+        self.assertEqual(list(self.t.items()), [((1, 2, 4), "D")])
+
+
+class TestSetTrieDictAggregate(unittest.TestCase):
+    """
+    UnitTest for SetTrieDict with aggregate function
+    """
+
+    def setUp(self):
+        self.items = [
+            ((1, 3), 6),
+            ((1, 3, 5), 2),
+            ((1, 4), 5),
+            ((1, 2, 4), 1),
+            ((2, 4), 4),
+            ((2, 3, 5), 3),
+        ]
+        self.t = SetTrieDict(self.items, aggregate=min)
+        self.s = SetTrieDict(self.items, aggregate=operator.add)
+
+    def test_aggregate_supersets(self):
+        self.assertEqual(self.t.aggregate_supersets((3, 5)), 2)
+        self.assertEqual(self.t.aggregate_supersets((1,)), 1)
+        self.assertEqual(self.t.aggregate_supersets(()), 1)
+        self.assertEqual(self.t.aggregate_supersets((6,)), None)
+        self.assertEqual(self.t.aggregate_supersets((6,), -1), -1)
+        self.assertEqual(self.s.aggregate_supersets((1,)), 14)
+        self.assertEqual(self.s.aggregate_supersets((4,)), 10)
+        self.assertEqual(self.s.aggregate_supersets(()), 21)
+
+    def test_aggregate_subsets(self):
+        self.assertEqual(self.t.aggregate_subsets((1, 3, 5)), 2)
+        self.assertEqual(self.s.aggregate_subsets((1, 2, 4)), 10)
+        self.assertEqual(self.s.aggregate_subsets((1, 2)), None)
+
+    def test_update(self):
+        self.t[1, 2, 4] = 10
+        self.assertEqual(self.t.aggregate_supersets((1,)), 2)
+        self.t[(7,)] = 0
+        self.assertEqual(self.t.aggregate_supersets(()), 0)
+        del self.t[(7,)]
+        self.assertEqual(self.t.aggregate_supersets(()), 2)
+        self.assertEqual(self.t.pop((1, 3, 5)), 2)
+        self.assertEqual(self.t.aggregate_supersets((1,)), 5)
+        self.assertEqual(self.t.aggregate_supersets((3,)), 3)
+        self.s.pop((1, 3))
+        self.assertEqual(self.s.aggregate_supersets((1, 3)), 2)
+
+    def test_remove(self):
+        self.t.remove_supersets((1, 2))
+        self.assertEqual(self.t.aggregate_supersets(()), 2)
+        self.s.remove_subsets((1, 3, 5))
+        self.assertEqual(self.s.aggregate_supersets((1,)), 6)
+        self.s.discard_many([(1, 4), (2, 4)])
+        self.assertEqual(self.s.aggregate_supersets(()), 4)
+
+    def test_pickle(self):
+        t = pickle.loads(pickle.dumps(SetTrieDict(aggregate=min)))
+        self.assertEqual(t.aggregate_supersets((), -1), -1)
+        t[1, 2] = 3
+        self.assertEqual(t.aggregate_supersets(()), 3)
+
+        t = pickle.loads(pickle.dumps(self.t))
+        self.assertEqual(t.aggregate_supersets((3, 5)), 2)
+        self.assertEqual(t.aggregate_supersets((6,), -1), -1)
+        t = copy.deepcopy(self.s)
+        self.assertEqual(t.aggregate_supersets((6,), -1), -1)
+        self.assertEqual(t.aggregate_supersets((4,)), 10)
+
+    def test_wide_root(self):
+        calls = []
+
+        def add(lhs, rhs):
+            calls.append(None)
+            return lhs + rhs
+
+        n = 2000
+        t = SetTrieDict((((i,), i) for i in range(n)), aggregate=add)
+        self.assertEqual(t.aggregate_supersets(()), sum(range(n)))
+        self.assertLess(len(calls), 2 * n)
+
+        # each write only costs its path, not the fan-out of the root
+        del calls[:]
+        for i in range(n, 2 * n):
+            t[i, i + 1] = 1
+        self.assertLess(len(calls), 3 * n)
+
+        def min_(lhs, rhs):
+            calls.append(None)
+            return min(lhs, rhs)
+
+        items = [((i,), i) for i in range(n)] + [((i, i + n), i + n) for i in range(n)]
+        m = SetTrieDict(items, aggregate=min_)
+
+        # the refresh stops at (i,) as its aggregate is unchanged
+        del calls[:]
+        for i in range(n):
+            m[i, i + n] = i + n + 1
+        self.assertLess(len(calls), 3 * n)
+        self.assertEqual(m.aggregate_supersets((n,)), n + 1)
+        self.assertEqual(m.aggregate_supersets(()), 0)
+
+    def test_no_aggregate(self):
+        t = SetTrieDict(self.items)
+        self.assertRaises(ValueError, t.aggregate_supersets, (1,))
+        self.assertRaises(ValueError, t.aggregate_subsets, (1,))
+
+
+class TestDurableSetTrie(unittest.TestCase):
+    """
+    UnitTest for DurableSetTrie and DurableSetTrieDict class
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_reopen(self):
+        with DurableSetTrie(self.path, [(1, 3), (1, 3, 5), (2, 4)]) as t:
+            t.add((4, 2, 6))
+            t.discard((1, 3))
+        with DurableSetTrie(self.path) as t:
+            self.assertCountEqual(list(t), [(1, 3, 5), (2, 4), (2, 4, 6)])
+            self.assertEqual(repr(t), "<DurableSetTrie with 3 sets>")
+
+    def test_checkpoint(self):
+        with DurableSetTrie(self.path, checkpoint_every=3) as t:
+            for i in range(4):
+                t.add((i, i + 1))
+            t.discard((0, 1))
+            self.assertEqual(t._log.records, 2)
+        with DurableSetTrie(self.path) as t:
+            self.assertCountEqual(list(t), [(1, 2), (2, 3), (3, 4)])
+            t.checkpoint()
+        self.assertEqual(os.path.getsize(os.path.join(self.path, "log")), 0)
+        with DurableSetTrie(self.path) as t:
+            self.assertCountEqual(list(t), [(1, 2), (2, 3), (3, 4)])
+
+    def test_torn_tail(self):
+        with DurableSetTrie(self.path, [(1, 2), (3, 4)]):
+            pass
+        with open(os.path.join(self.path, "log"), "ab") as fp:
+            fp.write(b"\x01\xff\x00")
+        with DurableSetTrie(self.path) as t:
+            self.assertCountEqual(list(t), [(1, 2), (3, 4)])
+            t.add((5,))
+        with DurableSetTrie(self.path) as t:
+            self.assertCountEqual(list(t), [(1, 2), (3, 4), (5,)])
+
+    def test_remove(self):
+        with DurableSetTrie(self.path, [(1, 3), (1, 3, 5), (2, 4), (2, 5)]) as t:
+            t.remove_supersets((3,))
+            t.discard_many([(2, 5)])
+        with DurableSetTrie(self.path) as t:
+            self.assertEqual(list(t), [(2, 4)])
+        path = os.path.join(self.path, "dict")
+        with DurableSetTrieDict(path, [((1, 3), "A"), ((2, 4), "B")]) as t:
+            self.assertEqual(t.remove_subsets((1, 2, 3)), [((1, 3), "A")])
+        with DurableSetTrieDict(path) as t:
+            self.assertEqual(list(t.items()), [((2, 4), "B")])
+
+    def test_operators(self):
+        with DurableSetTrie(self.path, [(1, 2), (3, 4)]) as t:
+            result = t & {(1, 2)}
+            self.assertIsInstance(result, SetTrie)
+            self.assertNotIsInstance(result, DurableSetTrie)
+            self.assertEqual(list(result), [(1, 2)])
+            self.assertCountEqual(list(t | {(5,)}), [(1, 2), (3, 4), (5,)])
+            self.assertEqual(list(t - {(1, 2)}), [(3, 4)])
+            self.assertCountEqual(list(t ^ {(1, 2), (6,)}), [(3, 4), (6,)])
+            t |= {(5,)}
+        with DurableSetTrie(self.path) as t:
+            self.assertCountEqual(list(t), [(1, 2), (3, 4), (5,)])
+
+    def test_closed(self):
+        t = DurableSetTrie(self.path, [(1, 3)])
+        t.close()
+        self.assertRaises(ValueError, t.add, (2,))
+        self.assertRaises(ValueError, t.discard, (1, 3))
+        self.assertRaises(ValueError, t.remove_supersets, (1,))
+        self.assertRaises(ValueError, t.sync)
+        self.assertRaises(ValueError, t.checkpoint)
+        self.assertEqual(list(t), [(1, 3)])
+        t.close()
+
+        d = DurableSetTrieDict(os.path.join(self.path, "dict"), [((1, 3), "A")])
+        d.close()
+        with self.assertRaises(ValueError):
+            d[2,] = "B"
+        with self.assertRaises(ValueError):
+            del d[1, 3]
+        self.assertRaises(ValueError, d.pop, (1, 3), None)
+        self.assertRaises(ValueError, d.discard_many, [(1, 3)])
+        self.assertEqual(list(d.items()), [((1, 3), "A")])
+
+    def test_dict(self):
+        with DurableSetTrieDict(self.path, [((1, 3), "A"), ((2, 4), "B")]) as t:
+            t[1, 3] = "AAA"
+            t[5, 6] = "C"
+            self.assertEqual(t.pop((2, 4)), "B")
+            self.assertEqual(t.pop((2, 4), None), None)
+            self.assertRaises(KeyError, t.pop, (2, 4))
+            del t[5, 6]
+            t[7, 8] = "D"
+        with DurableSetTrieDict(self.path, aggregate=min) as t:
+            self.assertCountEqual(list(t.items()), [((1, 3), "AAA"), ((7, 8), "D")])
+            self.assertEqual(t.aggregate_supersets(()), "AAA")
+
+
+class TestShardedSetTrie(unittest.TestCase):
+    """
+    UnitTest for ShardedSetTrie class
+    """
+
+    def setUp(self):
+        self.t = ShardedSetTrie(
+            [(1, 3), (1, 3, 5), (1, 4), (1, 2, 4), (2, 4), (2, 3, 5)], shards=3
+        )
+
+    def tearDown(self):
+        self.t.close()
+
+    def test_iter(self):
+        self.assertCountEqual(
+            list(self.t),
+            [(1, 2, 4), (1, 3), (1, 3, 5), (1, 4), (2, 3, 5), (2, 4)],
+        )
+        self.assertEqual(len(self.t), 6)
+
+    def test_repr(self):
+        self.assertEqual(repr(self.t), "<ShardedSetTrie with 6 sets in 3 shards>")
+
+    def test_contains(self):
+        self.assertIn((1, 3), self.t)
+        self.assertIn({3, 1}, self.t)
+        self.assertNotIn((1,), self.t)
+        self.assertNotIn((1, 3, 5, 7), self.t)
+
+    def test_has_superset(self):
+        self.assertTrue(self.t.has_superset((3, 5)))
+        self.assertFalse(self.t.has_superset((6,)))
+        self.assertFalse(self.t.has_superset((2, 4, 5)))
+
+    def test_supersets(self):
+        self.assertCountEqual(self.t.iter_supersets((3, 5)), [(1, 3, 5), (2, 3, 5)])
+        self.assertCountEqual(
+            self.t.iter_supersets((2,)), [(1, 2, 4), (2, 3, 5), (2, 4)]
+        )
+        self.assertCountEqual(self.t.iter_supersets((6,)), [])
+
+    def test_has_subset(self):
+        self.assertTrue(self.t.has_subset((1, 2, 3)))
+        self.assertFalse(self.t.has_subset((3, 4, 5)))
+
+    def test_subsets(self):
+        self.assertCountEqual(
+            self.t.iter_subsets((1, 2, 4, 11)), [(1, 2, 4), (1, 4), (2, 4)]
+        )
+        self.assertCountEqual(self.t.iter_subsets((1, 2)), [])
+
+    def test_remove(self):
+        self.assertEqual(self.t.remove_supersets((3,)), 3)
+        self.assertEqual(self.t.remove_subsets((1, 4)), 1)
+        self.assertEqual(self.t.discard_many([(2, 4), (4, 2), (9,)]), 1)
+        self.assertEqual(list(self.t), [(1, 2, 4)])
+
+    def test_error(self):
+        self.assertRaises(TypeError, list, self.t.iter_supersets(["a"]))
+        self.assertEqual(len(self.t), 6)
+        self.assertTrue(self.t.has_superset((3, 5)))
+
+    def test_operators(self):
+        result = self.t & {(1, 3), (9,)}
+        self.assertIs(type(result), SetTrie)
+        self.assertEqual(list(result), [(1, 3)])
+        self.assertIs(type(self.t | {(9,)}), SetTrie)
+        self.assertEqual(len(self.t | {(9,)}), 7)
+        self.assertEqual(len(self.t - {(1, 3)}), 5)
+        self.assertCountEqual(
+            list(self.t ^ {(1, 3), (9,)}),
+            [(1, 2, 4), (1, 3, 5), (1, 4), (2, 3, 5), (2, 4), (9,)],
+        )
+
+    def test_stream(self):
+        self.t.batch_size = 1
+        self.t |= [(i, 100) for i in range(20)]
+        expected = [(i, 100) for i in range(20)] + [
+            (1, 2, 4),
+            (1, 3),
+            (1, 3, 5),
+            (1, 4),
+            (2, 3, 5),
+            (2, 4),
+        ]
+
+        # other calls are fine in between batches
+        result = []
+        for aset in self.t:
+            result.append(aset)
+            self.assertEqual(len(self.t), 26)
+        self.assertCountEqual(result, expected)
+        self.assertEqual(len(list(self.t.iter_supersets((100,)))), 20)
+
+        # abandoned in the middle
+        it = self.t.iter_subsets(range(101))
+        next(it)
+        it.close()
+        self.assertCountEqual(list(self.t), expected)
+
+    def test_closed(self):
+        self.t.close()
+        self.assertRaises(ValueError, self.t.add, (1,))
+        self.assertRaises(ValueError, len, self.t)
+        self.assertRaises(ValueError, list, self.t)
+        self.assertRaises(ValueError, self.t.__contains__, (1, 3))
+        self.assertRaises(ValueError, self.t.has_subset, (1, 3))
+        self.assertRaises(ValueError, self.t.discard_many, [(1, 3)])
+        self.t.close()
+
+    def test_finalize(self):
+        t = ShardedSetTrie([(1, 2)], shards=2)
+        procs = list(t._procs)
+        del t
+        gc.collect()
+        for proc in procs:
+            self.assertFalse(proc.is_alive())
+
+    def test_add_discard(self):
+        self.t.add([7, 6])
+        self.assertIn((6, 7), self.t)
+        self.t.discard((1, 3))
+        self.assertIn([1, 3, 5], self.t)
+        self.assertNotIn([1, 3], self.t)
+        self.assertEqual(len(self.t), 6)
+
+
+class TestShardedSetTrieDict(unittest.TestCase):
+    """
+    UnitTest for ShardedSetTrieDict class
+    """
+
+    def setUp(self):
+        self.t = ShardedSetTrieDict(
+            [
+                ((1, 3), "A"),
+                ((1, 3, 5), "B"),
+                ((1, 4), "C"),
+                ((1, 2, 4), "D"),
+                ((2, 4), "E"),
+                ((2, 3, 5), "F"),
+            ],
+            shards=3,
+        )
+
+    def tearDown(self):
+        self.t.close()
+
+    def test_get_set(self):
+        self.assertEqual(self.t.get((1, 3)), "A")
+        self.assertEqual(self.t[2, 3, 5], "F")
+        self.assertEqual(self.t.get((1, 2, 3), 0xDEADBEEF), 0xDEADBEEF)
+        self.t[1, 3] = "AAA"
+        self.assertEqual(self.t.get((1, 3)), "AAA")
+        self.assertEqual(len(self.t), 6)
+
+    def test_supersets(self):
+        self.assertCountEqual(
+            self.t.iter_supersets((3, 5)), [((1, 3, 5), "B"), ((2, 3, 5), "F")]
+        )
+
+    def test_subsets(self):
+        self.assertCountEqual(
+            self.t.iter_subsets((1, 2, 4)),
+            [((1, 2, 4), "D"), ((1, 4), "C"), ((2, 4), "E")],
+        )
+
+    def test_iters(self):
+        self.assertCountEqual(
+            list(self.t.items()),
+            [
+                ((1, 2, 4), "D"),
+                ((1, 3), "A"),
+                ((1, 3, 5), "B"),
+                ((1, 4), "C"),
+                ((2, 3, 5), "F"),
+                ((2, 4), "E"),
+            ],
+        )
+        self.assertCountEqual(self.t.values(), ["D", "A", "B", "C", "F", "E"])
+
+    def test_remove(self):
+        self.assertCountEqual(
+            self.t.remove_supersets((3,)),
+            [((1, 3), "A"), ((1, 3, 5), "B"), ((2, 3, 5), "F")],
+        )
+        self.assertCountEqual(
+            self.t.discard_many([(1, 4), (2, 4)]), [((1, 4), "C"), ((2, 4), "E")]
+        )
+        self.assertEqual(self.t.remove_subsets((1, 2, 4)), [((1, 2, 4), "D")])
+        self.assertEqual(len(self.t), 0)
+
+    def test_stream(self):
+        self.t.batch_size = 2
+        self.assertCountEqual(list(self.t.keys()), [k for k, _ in self.t.items()])
+        self.assertCountEqual(list(self.t.values()), ["D", "A", "B", "C", "F", "E"])
+
+    def test_pop(self):
+        self.assertEqual(self.t.pop([1, 3]), "A")
+        self.assertNotIn([1, 3], self.t)
+        self.assertEqual(self.t.pop([1, 3], None), None)
+        self.assertRaises(KeyError, self.t.pop, [1, 3])
+        with self.assertRaises(KeyError):
+            del self.t[1, 3]
+
 
 if __name__ == "__main__":
     unittest.main()